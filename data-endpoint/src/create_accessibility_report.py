@@ -2,22 +2,45 @@
 #
 # Generate report with SPARQL endpoint accessibility.
 #
+import io
 import enum
 import os
 import csv
-import json
+import asyncio
+import dataclasses
 import logging
 import datetime
 import argparse
 import typing
+import urllib.parse
 import urllib.request
+import functools
 import contextlib
-import pathlib
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+import httpx
+import ijson
+import orjson
 
 TIMEOUT_SECOND = 5
 
+CONNECT_TIMEOUT_SECOND = 1
+
+MAX_CONNECTIONS = 128
+
+MAX_KEEPALIVE_CONNECTIONS = 64
+
+ASK_QUERY = "ASK WHERE { ?s ?p ?o }"
+
+# The query is identical for every probe, encode it only once.
+ASK_QUERY_STRING = urllib.parse.urlencode(
+    {
+        "query": ASK_QUERY,
+        "format": "application/sparql-results+json",
+    }
+)
+
+ASK_HEADERS = {"Accept": "application/sparql-results+json"}
+
 TIME_FORMAT = "%Y-%m-%d"
 
 STATUS_UNAVAILABLE = "unavailable"
@@ -26,6 +49,48 @@ STATUS_QUERY_FAILED = "invalid"
 
 STATUS_AVAILABLE = "available"
 
+REPORT_CONTEXT = {
+    "@base": "https://skodapetr.github.io/horizon/v1/data/sparql/2023-07-11/",
+    "@vocab": "https://skodapetr.github.io/horizon/v1/schema#",
+    "xsd": "http://www.w3.org/2001/XMLSchema#",
+    "void": "http://rdfs.org/ns/void#",
+    "url": {"@id": "void:sparqlEndpoint", "@type": "@id"},
+    "endpoint": {"@type": "@id"},
+    "lastAvailable": {"@type": "xsd:date"},
+    "status": {
+        "@type": "@id",
+        "@context": {
+            "@base": "https://skodapetr.github.io/horizon/v1/resource/SparqlStatus/"
+        },
+    },
+    "created": {
+        "@type": "xsd:date",
+        "@id": "dcterms:created",
+    },
+}
+
+
+class Endpoint(typing.NamedTuple):
+    # Resource.
+    resource: str
+    # Relative, use to construct report URL.
+    relative: str
+    # SPARQL Endpoint URL.
+    url: str
+
+
+@dataclasses.dataclass(slots=True)
+class ReportItem:
+    # Relative resource, serialized as @id.
+    relative: str
+    # Endpoint resource.
+    endpoint: str
+    # SPARQL Endpoint URL.
+    url: str
+    status: str
+    # Date of last successful probe, for unavailable endpoints only.
+    last_available: typing.Optional[str] = None
+
 
 def read_arguments() -> dict[str, str]:
     parser = argparse.ArgumentParser()
@@ -39,6 +104,10 @@ def read_arguments() -> dict[str, str]:
         required=True,
         help="Path to directory where to write output.",
     )
+    parser.add_argument(
+        "--previous-report",
+        help="Path to previous report. Defaults to sparql.json in the output directory.",
+    )
     parser.add_argument(
         "--symlink",
         action="store_true",
@@ -50,8 +119,11 @@ def read_arguments() -> dict[str, str]:
 def main(args):
     initialize_logging()
     endpoints = load_endpoints(args["sparql_endpoints"])
-    availability = test_endpoints_availability(endpoints)
-    report_file = write_report(availability, args["output_directory"])
+    previous_report = args["previous_report"] or os.path.join(
+        args["output_directory"], "sparql.json"
+    )
+    availability, last_report = test_endpoints_availability(endpoints, previous_report)
+    report_file = write_report(availability, args["output_directory"], last_report)
     if args["symlink"]:
         symlink_report(args["output_directory"], report_file)
 
@@ -65,128 +137,202 @@ def initialize_logging():
 
 
 def load_endpoints(path: str):
+    """Yield endpoints one by one as they are parsed from the input."""
     with open_stream(path) as stream:
-        content = json.load(stream)
-    base = content["@context"]["@base"]
-    return [
-        {
-            # Resource.
-            "@id": base + item["@id"],
-            # Relative, use to construct report URL.
-            "relative": item["@id"],
-            # SPARQL Endpoint URL.
-            "url": item["url"],
-        }
-        for item in content["endpoint"]
-    ]
+        base = None
+        item = None
+        for prefix, event, value in ijson.parse(stream):
+            if prefix == "@context.@base":
+                base = value
+            elif prefix == "endpoint.item" and event == "start_map":
+                item = {}
+            elif prefix == "endpoint.item" and event == "end_map":
+                yield Endpoint(base + item["@id"], item["@id"], item["url"])
+                item = None
+            elif item is not None and prefix.startswith("endpoint.item."):
+                item[prefix[len("endpoint.item.") :]] = value
 
 
 def open_stream(path: str):
     if path.startswith("http"):
-        return url_as_lines(path)
+        return url_as_stream(path)
     else:
         return open(path, encoding="utf-8", newline="")
 
 
 @contextlib.contextmanager
-def url_as_lines(url: str):
+def url_as_stream(url: str):
     with urllib.request.urlopen(url) as response:
-        lines = [line.decode("utf-8") for line in response.readlines()]
-        yield lines
+        # Decode lazily instead of buffering the whole response.
+        yield io.TextIOWrapper(response, encoding="utf-8", newline="")
+
+
+def test_endpoints_availability(
+    endpoints, previous_report: typing.Optional[str] = None
+):
+    """Probe endpoints, loading the previous report while probes run."""
+    endpoints = list(endpoints)
+    return asyncio.run(_test_endpoints(endpoints, previous_report))
 
 
-def test_endpoints_availability(endpoints):
-    result = []
+async def _test_endpoints(endpoints, previous_report):
+    # The same endpoint often appears under trivially different URLs,
+    # e.g. with and without a trailing slash. Group endpoints by the
+    # canonical URL, probe each group only once and share the status.
+    groups: dict[str, list[int]] = {}
     for index, endpoint in enumerate(endpoints):
-        url = endpoint["url"]
-        available, can_query = test_endpoint(url)
-        if not available:
-            status = STATUS_UNAVAILABLE
-        elif not can_query:
-            status = STATUS_QUERY_FAILED
-        else:
-            status = STATUS_AVAILABLE
-        logging.info(f"{index + 1}/{len(endpoints)} '{url}' : {status}")
-        result.append({**endpoint, "status": status})
-        if index > 3:
-            break
-    return result
-
-
-def test_endpoint(url: str) -> tuple[bool, bool]:
+        groups.setdefault(_canonical_url(endpoint.url), []).append(index)
+    # Probes are independent requests waiting on remote servers, run
+    # them concurrently on a shared connection pool. With HTTP/2 probes
+    # to the same host multiplex over a single connection; servers
+    # without HTTP/2 support fall back to HTTP/1.1 keep-alive.
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+    )
+    progress = {"completed": 0, "total": len(groups)}
+    # Bound the number of probes in flight, including their TCP
+    # preflight, so probes queued behind slow endpoints wait for a
+    # free slot instead of timing out on connection pool acquisition.
+    semaphore = asyncio.Semaphore(MAX_CONNECTIONS)
+    async with httpx.AsyncClient(
+        http2=True, timeout=TIMEOUT_SECOND, limits=limits
+    ) as client:
+        tasks = [
+            _test_endpoint(client, endpoints[indexes[0]], semaphore, progress)
+            for indexes in groups.values()
+        ]
+        # Parse the previous report in a worker thread while the probes
+        # wait on the network, so it is ready when the last probe ends.
+        probed, last_report = await asyncio.gather(
+            asyncio.gather(*tasks),
+            asyncio.to_thread(load_previous_report, previous_report),
+        )
+    result = [None] * len(endpoints)
+    for indexes, (_, status) in zip(groups.values(), probed):
+        for index in indexes:
+            result[index] = (endpoints[index], status)
+    return result, last_report
+
+
+async def _test_endpoint(client, endpoint: Endpoint, semaphore, progress):
+    async with semaphore:
+        available, can_query = await _probe(client, endpoint.url)
+    if not available:
+        status = STATUS_UNAVAILABLE
+    elif not can_query:
+        status = STATUS_QUERY_FAILED
+    else:
+        status = STATUS_AVAILABLE
+    progress["completed"] += 1
+    logging.info(
+        f"{progress['completed']}/{progress['total']} '{endpoint.url}' : {status}"
+    )
+    return endpoint, status
+
+
+async def _probe(client, url: str) -> tuple[bool, bool]:
     """Using a simple ASK query test the endpoint."""
-    endpoint = SPARQLWrapper(url)
-    endpoint.setTimeout(TIMEOUT_SECOND)
-    endpoint.setQuery("SELECT ?s ?p ?o WHERE{ ?s ?p ?o } LIMIT 1")
-    endpoint.setReturnFormat(JSON)
+    # Dead endpoints usually fail already on TCP connect, check that
+    # first with a short timeout instead of paying the full query timeout.
+    if not await _is_reachable(url):
+        return False, False
+    probe_url = url + ("&" if "?" in url else "?") + ASK_QUERY_STRING
     try:
-        response = endpoint.query().convert()
-    except:
+        response = await client.get(probe_url, headers=ASK_HEADERS)
+    except (httpx.HTTPError, httpx.InvalidURL):
         return False, False
-    if not type(response) == dict or "boolean" not in response:
+    try:
+        body = response.json()
+    except ValueError:
+        return True, False
+    if not (isinstance(body, dict) and "boolean" in body):
         return True, False
     return True, True
 
 
-def write_report(endpoints: list, directory: str) -> str:
-    today = datetime.datetime.today()
+async def _is_reachable(url: str) -> bool:
+    address = _endpoint_address(url)
+    if address is None:
+        return False
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(*address), CONNECT_TIMEOUT_SECOND
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def _canonical_url(url: str) -> str:
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit(
+        (
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path.rstrip("/") or "/",
+            parts.query,
+            "",
+        )
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _endpoint_address(url: str) -> typing.Optional[tuple[str, int]]:
+    parsed = urllib.parse.urlparse(url)
+    if parsed.hostname is None:
+        return None
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    return parsed.hostname, port
+
+
+def write_report(availability: list, directory: str, last_report=None) -> str:
+    today = datetime.datetime.today().strftime(TIME_FORMAT)
 
-    availability_map = {}
+    # For each endpoint keep only the status and last availability
+    # of the previous report, that is all the loop below needs.
+    previous_availability = {}
     last_date = None
-    last_report = load_json(os.path.join(directory, "sparql.json"))
     if last_report is not None:
         last_date = last_report["metadata"]["created"]
         logging.info(f"Loaded last report from {last_date}.")
-        availability_map = {
-            report_item["@id"]: report_item for report_item in last_report["report"]
+        previous_availability = {
+            report_item["@id"]: (report_item["status"], report_item.get("lastAvailable"))
+            for report_item in last_report["report"]
         }
 
     report_items = []
-    for endpoint in endpoints:
-        report_item = {
-            "@id": endpoint["relative"],
-            "endpoint": endpoint["@id"],
-            "url": endpoint["url"],
-            "status": endpoint["status"],
-        }
+    for endpoint, status in availability:
         # Add information about last time we see in online.
-        if not endpoint["status"] == STATUS_AVAILABLE:
-            last_available = None
-            last_report = availability_map.get(report_item["@id"], None)
-            if last_report is not None:
-                if last_report["status"] == STATUS_AVAILABLE:
-                    last_available = last_date
-                else:
-                    last_available = last_report.get("lastAvailable", None)
-            if last_available is not None:
-                report_item["lastAvailable"] = last_available
+        last_available = None
+        if not status == STATUS_AVAILABLE:
+            previous_status, previous_available = previous_availability.get(
+                endpoint.relative, (None, None)
+            )
+            if previous_status == STATUS_AVAILABLE:
+                last_available = last_date
+            else:
+                last_available = previous_available
         # Store to item list.
-        report_items.append(report_item)
+        report_items.append(
+            ReportItem(
+                endpoint.relative, endpoint.resource, endpoint.url, status,
+                last_available,
+            )
+        )
 
     report = {
-        "@context": {
-            "@base": "https://skodapetr.github.io/horizon/v1/data/sparql/2023-07-11/",
-            "@vocab": "https://skodapetr.github.io/horizon/v1/schema#",
-            "xsd": "http://www.w3.org/2001/XMLSchema#",
-            "void": "http://rdfs.org/ns/void#",
-            "url": {"@id": "void:sparqlEndpoint", "@type": "@id"},
-            "endpoint": {"@type": "@id"},
-            "lastAvailable": {"@type": "xsd:date"},
-            "status": {
-                "@type": "@id",
-                "@context": {
-                    "@base": "https://skodapetr.github.io/horizon/v1/resource/SparqlStatus/"
-                },
-            },
-            "created": {
-                "@type": "xsd:date",
-                "@id": "dcterms:created",
-            },
-        },
+        "@context": REPORT_CONTEXT,
         "@id": "",
         "metadata": {
             "@id": "",
-            "created": today.strftime(TIME_FORMAT),
+            "created": today,
             "timeoutSecond": TIMEOUT_SECOND,
             "version": 1,
         },
@@ -198,28 +344,68 @@ def write_report(endpoints: list, directory: str) -> str:
     return output_path
 
 
-def report_path(directory: str, date: datetime.datetime):
-    file_name = f"sparql-{date.strftime(TIME_FORMAT)}.json"
-    return os.path.join(directory, file_name)
+def report_path(directory: str, date: str):
+    return os.path.join(directory, f"sparql-{date}.json")
+
+
+def load_previous_report(path: typing.Optional[str]):
+    if path is None or not os.path.exists(path):
+        return None
+    # Cache on the modification time so repeated calls for an
+    # unchanged report do not parse the file again.
+    return _load_json_cached(path, os.path.getmtime(path))
+
+
+@functools.lru_cache(maxsize=4)
+def _load_json_cached(path: str, modified: float):
+    return load_json(path)
 
 
 def load_json(path: str):
     if not os.path.exists(path):
         return None
-    with open(path, encoding="utf-8") as stream:
-        return json.load(stream)
+    with open(path, "rb") as stream:
+        return orjson.loads(stream.read())
 
 
 def write_json(path: str, content):
-    with open(path, "w", encoding="utf-8") as stream:
-        json.dump(content, stream, ensure_ascii=False, indent=2)
+    with open(path, "wb") as stream:
+        stream.write(
+            orjson.dumps(
+                content,
+                # Serialize dataclasses through the default hook to
+                # control the emitted keys.
+                option=orjson.OPT_INDENT_2 | orjson.OPT_PASSTHROUGH_DATACLASS,
+                default=_json_default,
+            )
+        )
+
+
+def _json_default(value):
+    if isinstance(value, ReportItem):
+        item = {
+            "@id": value.relative,
+            "endpoint": value.endpoint,
+            "url": value.url,
+            "status": value.status,
+        }
+        if value.last_available is not None:
+            item["lastAvailable"] = value.last_available
+        return item
+    raise TypeError
 
 
 def symlink_report(directory: str, target_path: str) -> None:
     """Update symlink to newly created file."""
-    symlink = pathlib.Path(directory) / "sparql.json"
-    symlink.unlink(missing_ok=True)
-    symlink.symlink_to(target_path)
+    symlink = os.path.join(directory, "sparql.json")
+    temporary = symlink + ".tmp"
+    if os.path.lexists(temporary):
+        os.unlink(temporary)
+    # Create the link aside and atomically swap it in, so readers
+    # never observe a missing sparql.json. The target is relative
+    # to keep the link valid when the directory is moved.
+    os.symlink(os.path.basename(target_path), temporary)
+    os.replace(temporary, symlink)
 
 
 if __name__ == "__main__":